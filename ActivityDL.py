@@ -1,9 +1,16 @@
 import argparse
-from datetime import datetime, timezone
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import hashlib
+import itertools
 import json
 from operator import itemgetter
 import os
+import queue
 import secrets
+import shutil
+import sqlite3
 import sys
 import threading
 import time
@@ -17,51 +24,168 @@ import dateutil.parser as dp
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
-
-
-USE_KEYRING = True
-EXPORT_ALL_WORKOUTS = False
-EXPORT_ONE_WORKOUT = False
-INCLUDE_AUTODETECTED_WORKOUTS = False
-GPX_FILENAME = None
-DO_NOT_UPDATE_DISTANCE = False
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is only needed for the parquet output
+    pa = None
+    pq = None
+
+
+# Withings endpoints
+AUTH_URL = 'https://account.withings.com/oauth2_user/authorize2'
+TOKEN_URL = 'https://wbsapi.withings.net/v2/oauth2'
+API_URL = 'https://wbsapi.withings.net/v2/measure'
+NOTIFY_URL = 'https://wbsapi.withings.net/notify'
+
+# Withings access tokens are valid for 3 hours; refresh a bit earlier in long runs
+ACCESS_TOKEN_LIFETIME = 10800 - 300
+# Withings activity notifications (appli=16) are sent when workouts are created or modified
+NOTIFY_APPLI_ACTIVITY = '16'
+# Notifications carry the start/end of the modified data; look back this far for the affected workouts
+NOTIFY_LOOKBACK = 86400
+# A notification whose handling failed is handled again after this delay, up to this many times
+WATCH_RETRY_SECONDS = 60
+WATCH_MAX_RETRIES = 5
+# Withings allows 120 requests per minute to each partner application (client id), whatever the user
+RATE_LIMIT_PER_MINUTE = 120
+# Summary fields requested for each workout
+WORKOUT_DATA_FIELDS = ('calories,intensity,manual_distance,manual_calories,' +
+    'hr_average,hr_min,hr_max,hr_zone_0,hr_zone_1,hr_zone_2,hr_zone_3,' +
+    'pause_duration,algo_pause_duration,spo2_average,steps,distance,' +
+    'elevation,pool_laps,strokes,pool_length')
+# Summary fields used by the .tcx lap and by the manifest
+TCX_WORKOUT_DATA_FIELDS = 'calories,hr_average,hr_max,steps,distance'
+MANIFEST_WORKOUT_DATA_FIELDS = 'calories,hr_average,hr_min,hr_max,distance'
+# Intraday fields that can be requested, and those used by the .tcx trackpoints and parquet samples
+INTRADAY_DATA_FIELDS = 'steps,elevation,calories,distance,stroke,pool_lap,duration,heart_rate,spo2_auto'
+TCX_INTRADAY_DATA_FIELDS = 'steps,duration,distance,heart_rate'
+PARQUET_INTRADAY_DATA_FIELDS = 'steps,duration,distance,heart_rate,calories,elevation,spo2_auto'
+# Swimming intraday fields, only requested for workouts of these categories
+SWIM_INTRADAY_DATA_FIELDS = 'stroke,pool_lap'
+SWIM_CATEGORIES = {7}
+# Parallel workers used to list and fetch date windows when backfilling
+BACKFILL_WORKERS = 4
+# Completed backfill windows are recorded in this file in the output directory
+BACKFILL_CHECKPOINT = '.backfill_checkpoint.json'
+# Namespace of tcx elements, as seen by ElementTree when parsing
+TCX_NAMESPACE = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
+TCX_TAG = '{' + TCX_NAMESPACE + '}'
+# Raw intraday fields kept in the parquet samples, with their compact dtypes
+SAMPLE_FIELD_DTYPES = {'steps': 'UInt16', 'duration': 'UInt16', 'distance': 'float32', 'calories': 'float32',
+                       'elevation': 'float32', 'stroke': 'UInt16', 'pool_lap': 'UInt16', 'spo2_auto': 'float32'}
+# Name of the manifest index kept in the output directory
+MANIFEST_FILENAME = 'manifest.sqlite'
+# Maximum number of pooled HTTP connections shared by all accounts
+HTTP_POOL_SIZE = 16
+# Name of the job queue kept in the output directory, and attempts before a failed job is left aside
+JOBS_FILENAME = 'jobs.sqlite'
+JOB_MAX_ATTEMPTS = 3
 
 VERSION = "1.0.2"
 BUILD_TIME = "2023-10-23T21:30:00Z"
 BUILDER_NAME = "JM"
 
-def load_refresh_token_file():
+# A single session keeps HTTP connections alive across API calls and accounts
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# gpx dataframe used by enrichment worker processes, set by init_enrich_worker
+ENRICH_GPX_DF = None
+
+def load_refresh_token_file(filename = '.refresh_token'):
     refresh_token = None
-    if os.path.isfile('.refresh_token'):
+    if os.path.isfile(filename):
         # Open the file and read its contents
-        with open('.refresh_token', 'r') as file:
+        with open(filename, 'r') as file:
             refresh_token = file.read()
     return refresh_token
 
-def save_refresh_token_file(refresh_token):
-    with open('.refresh_token','w') as file:
+def save_refresh_token_file(refresh_token, filename = '.refresh_token'):
+    with open(filename,'w') as file:
         file.write(refresh_token)
 
-def load_refresh_token_keyring():
+def load_refresh_token_keyring(username = 'refresh_token'):
     refresh_token = None
-    refresh_token = keyring.get_password('ActivityDL','refresh_token')
+    refresh_token = keyring.get_password('ActivityDL',username)
     return refresh_token
 
-def save_refresh_token_keyring(refresh_token):
-    keyring.set_password('ActivityDL','refresh_token',refresh_token)
+def save_refresh_token_keyring(refresh_token, username = 'refresh_token'):
+    keyring.set_password('ActivityDL',username,refresh_token)
     pass
 
-def load_refresh_token():
-    if USE_KEYRING:
-        return load_refresh_token_keyring()
-    else:
-        return load_refresh_token_file()
+class KeyringTokenStore(object):
+    # Stores the refresh token of an account in the system keyring
+    def __init__(self, account = None) -> None:
+        self.username = 'refresh_token' if account is None else f'refresh_token_{account}'
+    def load(self):
+        return load_refresh_token_keyring(self.username)
+    def save(self, refresh_token):
+        save_refresh_token_keyring(refresh_token, self.username)
+
+class FileTokenStore(object):
+    # Stores the refresh token of an account in a file in the current directory
+    def __init__(self, account = None) -> None:
+        self.filename = '.refresh_token' if account is None else f'.refresh_token_{account}'
+    def load(self):
+        return load_refresh_token_file(self.filename)
+    def save(self, refresh_token):
+        save_refresh_token_file(refresh_token, self.filename)
+
+class RateLimiter(object):
+    # Spaces calls so that no more than calls_per_minute are made; safe to share between threads
+    def __init__(self, calls_per_minute = RATE_LIMIT_PER_MINUTE) -> None:
+        self.interval = 60.0 / calls_per_minute
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# One limiter per client id, shared by all the accounts using that application
+CLIENT_LIMITERS = {}
+CLIENT_LIMITERS_LOCK = threading.Lock()
+
+def get_client_limiter(client_id):
+    with CLIENT_LIMITERS_LOCK:
+        if client_id not in CLIENT_LIMITERS:
+            CLIENT_LIMITERS[client_id] = RateLimiter(RATE_LIMIT_PER_MINUTE)
+        return CLIENT_LIMITERS[client_id]
+
+class AccountSession(object):
+    # Rate limited view of the shared session for one account: calls are throttled by the limiter
+    # of its client id, and optionally by a lower calls_per_minute for this account alone
+    def __init__(self, session = SESSION, client_id = None, calls_per_minute = None) -> None:
+        self.session = session
+        self.client_limiter = get_client_limiter(client_id)
+        self.limiter = RateLimiter(calls_per_minute) if calls_per_minute is not None else None
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+    def post(self, *args, **kwargs):
+        if self.limiter is not None:
+            self.limiter.wait()
+        self.client_limiter.wait()
+        response = self.session.post(*args, **kwargs)
+        with self.lock:
+            self.bytes_received += wire_bytes(response)
+        return response
+
+def wire_bytes(response):
+    # Size of the response body as received, before any decompression (urllib3 counts the raw bytes read)
+    content = response.content
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(content)
 
-def save_refresh_token(refresh_token):
-    if USE_KEYRING:
-        save_refresh_token_keyring(refresh_token)
-    else:
-        save_refresh_token_file(refresh_token)
+class WithingsAPIError(Exception):
+    # A Withings API call still failing after its retries
+    pass
 
 def get_authorization_code(auth_url, client_id, redirect_url, callback_port):
     # Trigger a browser window for user authentication with some delay to allow for listener to start
@@ -117,8 +241,8 @@ def get_authorization_code(auth_url, client_id, redirect_url, callback_port):
         sys.exit(2)
     return httpd.auth_code
 
-def get_access_tokens_common(the_url, request_data):
-    response = requests.post(the_url, data=request_data)
+def get_access_tokens_common(the_url, request_data, session = SESSION):
+    response = session.post(the_url, data=request_data)
     tokens = response.json()
     #print(tokens)
     if tokens['status'] == 0:
@@ -131,7 +255,7 @@ def get_access_tokens_common(the_url, request_data):
     #print(access_token)
     return access_token, refresh_token
 
-def get_access_tokens_auth(token_url, client_id, client_secret, redirect_url, auth_code):
+def get_access_tokens_auth(token_url, client_id, client_secret, redirect_url, auth_code, session = SESSION):
     # Use the Authentication token to obtain Access and Refresh tokens
     data = {
         'action': 'requesttoken',
@@ -141,9 +265,9 @@ def get_access_tokens_auth(token_url, client_id, client_secret, redirect_url, au
         'redirect_uri': redirect_url,
         'code': auth_code
     }
-    return get_access_tokens_common(token_url, data)
+    return get_access_tokens_common(token_url, data, session)
 
-def get_access_tokens_refresh(token_url, client_id, client_secret, refresh_tok):
+def get_access_tokens_refresh(token_url, client_id, client_secret, refresh_tok, session = SESSION):
     data = {
         'action': 'requesttoken',
         'grant_type': 'refresh_token',
@@ -152,44 +276,43 @@ def get_access_tokens_refresh(token_url, client_id, client_secret, refresh_tok):
         'refresh_token': refresh_tok
     }
 
-    return get_access_tokens_common(token_url, data)
+    return get_access_tokens_common(token_url, data, session)
 
-def get_all_workouts_since(api_url, token, last_update):
-    # Connect to Withings API with the Access token
+def get_workouts(api_url, token, params, keep, session = SESSION, data_fields = WORKOUT_DATA_FIELDS):
+    # Page through getworkouts with the given params, keeping the workouts for which keep(wk) is true
     headers = {'Authorization': f'Bearer {token}'}
-    params = {
-        'action': 'getworkouts',
-        'offset': 0,
-        'lastupdate': last_update,
-        'data_fields': 'calories,intensity,manual_distance,manual_calories,' +
-            'hr_average,hr_min,hr_max,hr_zone_0,hr_zone_1,hr_zone_2,hr_zone_3,' +
-            'pause_duration,algo_pause_duration,spo2_average,steps,distance,' +
-            'elevation,pool_laps,strokes,pool_length'
-            }
+    params = dict(params, action='getworkouts', offset=0, data_fields=data_fields)
     more = True
 
     all_workouts = []
     while more:
-        response = requests.post(api_url, headers=headers, params=params).json()
+        response = session.post(api_url, headers=headers, params=params).json()
 
         if response['status'] == 0:
             workouts = response['body']['series']
             more = response['body']['more']
             offset = response['body']['offset']
-            # instead of all_workouts.extend(workouts), the following hack is needed because Withings API
-            # returns workouts starting or MODIFIED after lastupdate, and we do not want modified
-            # Also, the distinction between autodetected and manual workouts is considered depending on parameter choice
-            # Autodetected workouts are all those not confirmed by the user ('attrib' = 7)
-            all_workouts.extend(wk for wk in workouts if wk['startdate']>=last_update and (INCLUDE_AUTODETECTED_WORKOUTS or wk['attrib'] == 7 ))
+            all_workouts.extend(wk for wk in workouts if keep(wk))
 
             if more:
                 params['offset'] = offset
             print(f"Workouts obtained: {len(workouts)}, More: {more}, Total workouts: {len(all_workouts)}")
         else:
-            workouts = None
-            more = False
-            offset = None
-            print(f"Error: {response}")
+            # A partial list would look like a complete one, so the whole listing fails
+            raise WithingsAPIError(f"getworkouts: {response}")
+
+    return all_workouts
+
+def get_all_workouts_since(api_url, token, last_update, include_autodetected = False, session = SESSION,
+                           data_fields = WORKOUT_DATA_FIELDS):
+    # Connect to Withings API with the Access token
+    # instead of keeping all workouts, the following hack is needed because Withings API
+    # returns workouts starting or MODIFIED after lastupdate, and we do not want modified
+    # Also, the distinction between autodetected and manual workouts is considered depending on parameter choice
+    # Autodetected workouts are all those not confirmed by the user ('attrib' = 7)
+    all_workouts = get_workouts(api_url, token, {'lastupdate': last_update},
+                                lambda wk: wk['startdate']>=last_update and (include_autodetected or wk['attrib'] == 7 ),
+                                session, data_fields)
 
     all_workouts.sort(key=itemgetter('startdate','id'), reverse=False)
 
@@ -237,7 +360,16 @@ def get_all_workouts_since(api_url, token, last_update):
 
     return all_workouts
 
-def get_intradayactivity(api_url, access_token, startdate, enddate):
+def get_workouts_between(api_url, token, startdateymd, enddateymd, include_autodetected = False, session = SESSION,
+                         data_fields = WORKOUT_DATA_FIELDS):
+    # Workouts whose date is between startdateymd and enddateymd (both included, 'YYYY-MM-DD')
+    all_workouts = get_workouts(api_url, token, {'startdateymd': startdateymd, 'enddateymd': enddateymd},
+                                lambda wk: include_autodetected or wk['attrib'] == 7,
+                                session, data_fields)
+    all_workouts.sort(key=itemgetter('startdate','id'), reverse=False)
+    return all_workouts
+
+def get_intradayactivity(api_url, access_token, startdate, enddate, session = SESSION, data_fields = INTRADAY_DATA_FIELDS):
     
     max_attempts = 10
     seconds_to_wait = 8
@@ -247,22 +379,22 @@ def get_intradayactivity(api_url, access_token, startdate, enddate):
     'action': 'getintradayactivity',
     'startdate': startdate,
     'enddate': enddate,
-    'data_fields': 'steps,elevation,calories,distance,stroke,pool_lap,duration,heart_rate,spo2_auto'
+    'data_fields': data_fields
           }
     
     details = None
     attempt = 0
     while attempt < max_attempts:
-        response = requests.post(api_url, headers=headers, params=params).json()
+        response = session.post(api_url, headers=headers, params=params).json()
         if response['status'] == 0:
             details = response['body']['series']
             break
         else:
+            attempt += 1
             print(f"Server error. Waiting {seconds_to_wait} seconds before retrying...")
             time.sleep(seconds_to_wait)
     if details == None:
-        print(f"Error: {response} after {attempt} attempts.")
-        sys.exit(2)
+        raise WithingsAPIError(f"{response} after {attempt} attempts")
 
     # print(json.dumps(details, indent=2))
     #   "1697050739": {
@@ -291,27 +423,175 @@ def get_intradayactivity(api_url, access_token, startdate, enddate):
 
     return details
 
+def plan_workout_fields(outputs):
+    # Summary fields needed by the outputs ('tcx', 'manifest', 'parquet'), in the order of WORKOUT_DATA_FIELDS
+    if 'parquet' in outputs:
+        return WORKOUT_DATA_FIELDS
+    needed = set(TCX_WORKOUT_DATA_FIELDS.split(','))
+    if 'manifest' in outputs:
+        needed.update(MANIFEST_WORKOUT_DATA_FIELDS.split(','))
+    return ','.join(f for f in WORKOUT_DATA_FIELDS.split(',') if f in needed)
+
+def plan_intraday_fields(category, outputs):
+    # Intraday fields needed by the outputs for a workout of this category, in the order of INTRADAY_DATA_FIELDS
+    # The .tcx trackpoints only use heart rate, steps, duration (for cadence) and distance; parquet
+    # samples keep the other raw fields, and swimming fields are only reported for swimming workouts
+    needed = set(TCX_INTRADAY_DATA_FIELDS.split(','))
+    if 'parquet' in outputs:
+        needed.update(PARQUET_INTRADAY_DATA_FIELDS.split(','))
+        if category in SWIM_CATEGORIES:
+            needed.update(SWIM_INTRADAY_DATA_FIELDS.split(','))
+    return ','.join(f for f in INTRADAY_DATA_FIELDS.split(',') if f in needed)
+
 def timestamp_to_iso8601(ts):
     return datetime.fromtimestamp(ts,tz=timezone.utc).replace(microsecond=0).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 def timestamp_to_filename(ts):
     return datetime.fromtimestamp(ts,tz=timezone.utc).replace(microsecond=0).strftime("%Y-%m-%dT%H-%M-%SZ")
 
-def create_tcx(workout, details, loc_df = None):
+def date_windows(from_ts, to_ts, window = 'month'):
+    # Split the dates between two timestamps in consecutive ('YYYY-MM-DD', 'YYYY-MM-DD') windows
+    # Windows are calendar months (the first one may be partial) or weeks
+    start = datetime.fromtimestamp(from_ts).date()
+    end = datetime.fromtimestamp(to_ts).date()
+    windows = []
+    while start <= end:
+        if window == 'week':
+            next_start = start + timedelta(days=7)
+        else:
+            next_start = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        windows.append((start.isoformat(), min(next_start - timedelta(days=1), end).isoformat()))
+        start = next_start
+    return windows
+
+def resample_details(workout, details):
+    # Resample the intraday details to one row per second of the workout, keeping the real samples,
+    # and interpolate cadence, heart rate and cumulative distance ('distance_tcx')
+    starttime = timestamp_to_iso8601(int(workout['startdate']))
+    total_duration = float(int(workout['enddate']) - int(workout['startdate']) + 1)
+
+    df = pd.DataFrame.from_dict(details, orient='index')
+    # Resample index to every second in interval
+    df.index = pd.to_datetime(df.index.astype(int), unit='s', utc=True)
+    df['rs'] = 'Real'
+    hf_df = pd.date_range(start=starttime, freq='1s', periods=int(total_duration)).to_frame()
+    hf_df['rs'] = 'Synthetic'
+    df = pd.concat([df,hf_df])
+    # Delete duplicates
+    df = df[~df.index.duplicated(keep='first')]
+    df = df.sort_index(ascending=True)
+    df['Time'] = df.index.map(lambda x: timestamp_to_iso8601(int(x.timestamp())))
+
+    # Interpolate and fill cadence
+    if 'steps' in df.columns and 'duration' in df.columns:
+        df['cadence'] = 60.0 * df['steps'] / df['duration']
+        df['cadence'].interpolate(method='time', inplace=True)
+        df['cadence'].ffill(inplace=True)
+        df['cadence'].bfill(inplace=True)
+    else:
+        df['cadence'] = 0.0
+
+    # Interpolate and fill heart rate
+    if 'heart_rate' not in df.columns: df['heart_rate'] = np.nan
+    df['heart_rate'].interpolate(method='time', inplace=True)
+    df['heart_rate'].ffill(inplace=True)
+    df['heart_rate'].bfill(inplace=True)
+
+    # Interpolate and fill distance
+    # Withings reports distance per interval, and .tcx requires cumulative distance for trackpoints
+    if not 'distance' in df.columns: df['distance'] = 0.0
+    df['distance_tcx'] = df['distance'].cumsum()
+    df['distance_tcx'].iat[0] = 0.0
+    df['distance_tcx'].interpolate(method='time', inplace=True)
+    df['distance_tcx'].ffill(inplace=True)
+
+    return df
+
+def interpolate_from(values, x, anchors):
+    # Fill the missing values at times x (i8) by interpolating in time between anchors (a series of
+    # known values), and with the first or last anchor outside them; same as interpolate + ffill + bfill
+    if len(anchors) == 0:
+        return values
+    values = values.astype(float)
+    invalid = values.isna().to_numpy()
+    values[invalid] = np.interp(x[invalid], anchors.index.asi8, anchors.to_numpy(dtype=float))
+    return values
+
+def iter_resampled_details(workout, details, chunk_seconds):
+    # Same rows and values as resample_details, produced in consecutive chunks of chunk_seconds seconds
+    # Only the (sparse) real samples are kept for the whole workout: each chunk is interpolated from the
+    # closest real values around it, and cumulative distance carries over from the previous chunks
+    starttime_ts = int(workout['startdate'])
+    total_duration = int(workout['enddate']) - starttime_ts + 1
+
+    real_df = pd.DataFrame.from_dict(details, orient='index')
+    real_df.index = pd.to_datetime(real_df.index.astype(int), unit='s', utc=True)
+    real_df['rs'] = 'Real'
+    real_df = real_df[~real_df.index.duplicated(keep='first')]
+    real_df = real_df.sort_index(ascending=True)
+
+    # Known values used to interpolate each column
+    anchors = {}
+    if 'steps' in real_df.columns and 'duration' in real_df.columns:
+        anchors['cadence'] = (60.0 * real_df['steps'] / real_df['duration']).dropna()
+    anchors['heart_rate'] = real_df['heart_rate'].dropna() if 'heart_rate' in real_df.columns else pd.Series(dtype=float)
+    # Withings reports distance per interval, and .tcx requires cumulative distance for trackpoints
+    # Cumulative distance starts at 0.0 at the first row of the whole workout
+    if 'distance' in real_df.columns:
+        cumul_dist = real_df['distance'].cumsum()
+    else:
+        cumul_dist = pd.Series(0.0, index=real_df.index)
+    first_row = pd.Timestamp(starttime_ts, unit='s', tz='UTC')
+    if len(real_df) > 0:
+        first_row = min(first_row, real_df.index[0])
+    cumul_dist[first_row] = 0.0
+    anchors['distance_tcx'] = cumul_dist.sort_index().dropna()
+
+    for chunk_start in range(0, total_duration, chunk_seconds):
+        periods = min(chunk_seconds, total_duration - chunk_start)
+        hf_df = pd.date_range(start=timestamp_to_iso8601(starttime_ts + chunk_start), freq='1s', periods=periods).to_frame()
+        hf_df['rs'] = 'Synthetic'
+        # Real samples before the start or after the end of the workout go to the first or last chunk
+        in_chunk = np.full(len(real_df), True)
+        if chunk_start > 0:
+            in_chunk &= real_df.index >= hf_df.index[0]
+        if chunk_start + periods < total_duration:
+            in_chunk &= real_df.index <= hf_df.index[-1]
+        df = pd.concat([real_df[in_chunk], hf_df])
+        df = df[~df.index.duplicated(keep='first')]
+        df = df.sort_index(ascending=True)
+        df['Time'] = df.index.map(lambda x: timestamp_to_iso8601(int(x.timestamp())))
+        x = df.index.asi8
+
+        if 'cadence' in anchors:
+            cadence = 60.0 * df['steps'] / df['duration'] if 'steps' in df.columns and 'duration' in df.columns \
+                else pd.Series(np.nan, index=df.index)
+            df['cadence'] = interpolate_from(cadence, x, anchors['cadence'])
+        else:
+            df['cadence'] = 0.0
+        heart_rate = df['heart_rate'] if 'heart_rate' in df.columns else pd.Series(np.nan, index=df.index)
+        df['heart_rate'] = interpolate_from(heart_rate, x, anchors['heart_rate'])
+        if 'distance' not in real_df.columns: df['distance'] = 0.0
+        df['distance_tcx'] = interpolate_from(anchors['distance_tcx'].reindex(df.index), x, anchors['distance_tcx'])
+
+        yield df
+
+def createElementSeries(parent, data):
     # Parent is the parent element
     # Data is a dictionary with the key as the tag name and the value as the text in it
-    
+    for k, v in data.items():
+        elem = ET.SubElement(parent, k)
+        elem.text = v
+
+def create_tcx_skeleton(workout):
+    # Create the whole tcx tree of a workout except its trackpoints
+    # Returns the root, the (empty) Track element and the lap DistanceMeters element
     class trialContextManager:
         def __enter__(self): pass
         def __exit__(self, *args): return True
     
     trial = trialContextManager()
     
-    def createElementSeries(parent, data):
-        for k, v in data.items():
-            elem = ET.SubElement(parent, k)
-            elem.text = v
-
     # Model names obtained from:
     # https://developer.withings.com/api-reference/#tag/measure/operation/measurev2-getworkouts
     # https://developer.withings.com/api-reference/#tag/measure/operation/measurev2-getintradayactivity
@@ -426,101 +706,6 @@ def create_tcx(workout, details, loc_df = None):
     createElementSeries(lap_elt, {'TriggerMethod': 'Manual'})
     track_elt = ET.SubElement(lap_elt, 'Track')
 
-    df = pd.DataFrame.from_dict(details, orient='index')
-    # Resample index to every second in interval
-    df.index = pd.to_datetime(df.index.astype(int), unit='s', utc=True)
-    df['rs'] = 'Real'
-    hf_df = pd.date_range(start=starttime, freq='1s', periods=int(total_duration)).to_frame()
-    hf_df['rs'] = 'Synthetic'
-    df = pd.concat([df,hf_df])
-    # Delete duplicates
-    df = df[~df.index.duplicated(keep='first')]
-    df = df.sort_index(ascending=True)
-    df['Time'] = df.index.map(lambda x: timestamp_to_iso8601(int(x.timestamp())))
-
-    # Interpolate and fill cadence
-    if 'steps' in df.columns and 'duration' in df.columns:
-        df['cadence'] = 60.0 * df['steps'] / df['duration']
-        df['cadence'].interpolate(method='time', inplace=True)
-        df['cadence'].ffill(inplace=True)
-        df['cadence'].bfill(inplace=True)
-    else:
-        df['cadence'] = 0.0
-
-    # Interpolate and fill heart rate
-    if 'heart_rate' not in df.columns: df['heart_rate'] = np.nan
-    df['heart_rate'].interpolate(method='time', inplace=True)
-    df['heart_rate'].ffill(inplace=True)
-    df['heart_rate'].bfill(inplace=True)
-
-    # Interpolate and fill distance
-    # Withings reports distance per interval, and .tcx requires cumulative distance for trackpoints
-    if not 'distance' in df.columns: df['distance'] = 0.0
-    df['distance_tcx'] = df['distance'].cumsum()
-    df['distance_tcx'].iat[0] = 0.0
-    df['distance_tcx'].interpolate(method='time', inplace=True)
-    df['distance_tcx'].ffill(inplace=True)
-
-    if (not loc_df is None) & (not DO_NOT_UPDATE_DISTANCE):
-        try:
-            total_distance_elt.text = str(loc_df.loc[df.index[-1],'cumul_dist'])
-        except:
-            pass
-    else:
-        total_distance_elt.text = str(total_distance)
-    #df.to_csv('test.csv')
-
-    def create_trackpoint(p, ldf = None):
-        trackpoint_elt = ET.SubElement(track_elt, 'Trackpoint')
-        createElementSeries(trackpoint_elt, {'Time': str(p['Time'])})
-        if (not ldf is None):
-            lat_str, lon_str, ele_str = None, None, None
-            try:
-                lat = ldf.loc[p.name, 'latitude']
-                if not np.isnan(lat):
-                    lat_str = str(lat)
-                lon = ldf.loc[p.name, 'longitude']
-                if not np.isnan(lon):
-                    lon_str = str(lon)
-            except:
-                lat_str, lon_str = None, None
-            try:
-                ele = ldf.loc[p.name, 'elevation']
-                if not np.isnan(ele):
-                    ele_str = str(ele)
-            except:
-                ele_str = None
-            if (not lat_str is None) & (not lon_str is None):
-                pos_elt = ET.SubElement(trackpoint_elt, 'Position')
-                lat_elt = ET.SubElement(pos_elt, 'LatitudeDegrees')
-                lat_elt.text = lat_str
-                lon_elt = ET.SubElement(pos_elt, 'LongitudeDegrees')
-                lon_elt.text = lon_str
-                if not ele_str is None:
-                    ele_elt = ET.SubElement(trackpoint_elt, 'AltitudeMeters')
-                    ele_elt.text = ele_str
-
-        dist_elt = ET.SubElement(trackpoint_elt, 'DistanceMeters')
-        dist = str(p['distance_tcx'])
-        if (not ldf is None) & (not DO_NOT_UPDATE_DISTANCE):
-            try:
-                dist = str(ldf.loc[p.name, 'cumul_dist'])
-            except:
-                pass
-        dist_elt.text = dist
-
-        try:
-            hr_val = int(p['heart_rate'])
-            hr_elt = ET.SubElement(trackpoint_elt, 'HeartRateBpm')
-            createElementSeries(hr_elt, {'Value': str(hr_val)})
-        except:
-            pass
-        cadence_elt = ET.SubElement(trackpoint_elt, 'Cadence')
-        cadence_elt.text = str(int(p['cadence']))
-        sensorstate_elt = ET.SubElement(trackpoint_elt, 'SensorState')
-        sensorstate_elt.text = 'Present'
-    df.apply(create_trackpoint, args=(loc_df,), axis=1)
-
     # Create final activity elements
     attrib_type = str(workout['attrib'])
     if attrib_type in attrib_names:
@@ -559,11 +744,133 @@ def create_tcx(workout, details, loc_df = None):
     elem = ET.SubElement(author_elt, 'PartNumber')
     elem.text = 'XXX-XXXXX-XX'
 
+    return tcx_elt, track_elt, total_distance_elt
+
+def create_trackpoint(p, track_elt, ldf = None, do_not_update_distance = False):
+    trackpoint_elt = ET.SubElement(track_elt, 'Trackpoint')
+    createElementSeries(trackpoint_elt, {'Time': str(p['Time'])})
+    if (not ldf is None):
+        lat_str, lon_str, ele_str = None, None, None
+        try:
+            lat = ldf.loc[p.name, 'latitude']
+            if not np.isnan(lat):
+                lat_str = str(lat)
+            lon = ldf.loc[p.name, 'longitude']
+            if not np.isnan(lon):
+                lon_str = str(lon)
+        except:
+            lat_str, lon_str = None, None
+        try:
+            ele = ldf.loc[p.name, 'elevation']
+            if not np.isnan(ele):
+                ele_str = str(ele)
+        except:
+            ele_str = None
+        if (not lat_str is None) & (not lon_str is None):
+            pos_elt = ET.SubElement(trackpoint_elt, 'Position')
+            lat_elt = ET.SubElement(pos_elt, 'LatitudeDegrees')
+            lat_elt.text = lat_str
+            lon_elt = ET.SubElement(pos_elt, 'LongitudeDegrees')
+            lon_elt.text = lon_str
+            if not ele_str is None:
+                ele_elt = ET.SubElement(trackpoint_elt, 'AltitudeMeters')
+                ele_elt.text = ele_str
+
+    dist_elt = ET.SubElement(trackpoint_elt, 'DistanceMeters')
+    dist = str(p['distance_tcx'])
+    if (not ldf is None) & (not do_not_update_distance):
+        try:
+            dist = str(ldf.loc[p.name, 'cumul_dist'])
+        except:
+            pass
+    dist_elt.text = dist
+
+    try:
+        hr_val = int(p['heart_rate'])
+        hr_elt = ET.SubElement(trackpoint_elt, 'HeartRateBpm')
+        createElementSeries(hr_elt, {'Value': str(hr_val)})
+    except:
+        pass
+    cadence_elt = ET.SubElement(trackpoint_elt, 'Cadence')
+    cadence_elt.text = str(int(p['cadence']))
+    sensorstate_elt = ET.SubElement(trackpoint_elt, 'SensorState')
+    sensorstate_elt.text = 'Present'
+
+def create_tcx(workout, details, loc_df = None, do_not_update_distance = False, samples_df = None):
+    tcx_elt, track_elt, total_distance_elt = create_tcx_skeleton(workout)
+
+    df = samples_df if samples_df is not None else resample_details(workout, details)
+
+    if (not loc_df is None) & (not do_not_update_distance):
+        try:
+            total_distance_elt.text = str(loc_df.loc[df.index[-1],'cumul_dist'])
+        except:
+            pass
+    #df.to_csv('test.csv')
+
+    df.apply(create_trackpoint, args=(track_elt, loc_df, do_not_update_distance), axis=1)
+
     return tcx_elt
 
+class ChunkedTcxWriter(object):
+    # Writes a tcx file chunk by chunk: trackpoints are streamed to a temporary file, and the rest
+    # of the tree is written around them on close, once the total distance is known
+    # abort() removes the temporary files when the workout can not be completed
+    TRACKPOINTS_MARKER = 'ActivityDL-trackpoints'
+
+    def __init__(self, file_name, workout, do_not_update_distance = False) -> None:
+        self.file_name = file_name
+        self.do_not_update_distance = do_not_update_distance
+        self.tcx_elt, self.track_elt, self.total_distance_elt = create_tcx_skeleton(workout)
+        self.trackpoints_file_name = file_name + '.trackpoints'
+        self.trackpoints_file = open(self.trackpoints_file_name, 'w', encoding='UTF-8', errors='xmlcharrefreplace')
+        self.last_index = None
+        self.last_loc_df = None
+
+    def write(self, samples_df, loc_df = None):
+        track_elt = ET.Element('Track')
+        samples_df.apply(create_trackpoint, args=(track_elt, loc_df, self.do_not_update_distance), axis=1)
+        for trackpoint_elt in track_elt:
+            self.trackpoints_file.write(ET.tostring(trackpoint_elt, encoding='unicode', short_empty_elements=False))
+        self.last_index = samples_df.index[-1]
+        self.last_loc_df = loc_df
+
+    def close(self):
+        self.trackpoints_file.close()
+        if (not self.last_loc_df is None) & (not self.do_not_update_distance):
+            try:
+                self.total_distance_elt.text = str(self.last_loc_df.loc[self.last_index,'cumul_dist'])
+            except:
+                pass
+        self.track_elt.text = self.TRACKPOINTS_MARKER
+        head, tail = ET.tostring(self.tcx_elt, encoding='unicode', short_empty_elements=False).split(self.TRACKPOINTS_MARKER)
+        with open(self.file_name + '.tmp', 'w', encoding='UTF-8', errors='xmlcharrefreplace') as file:
+            file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+            file.write(head)
+            with open(self.trackpoints_file_name, 'r', encoding='UTF-8') as trackpoints_file:
+                shutil.copyfileobj(trackpoints_file, file)
+            file.write(tail)
+        os.replace(self.file_name + '.tmp', self.file_name)
+        os.remove(self.trackpoints_file_name)
+
+    def abort(self):
+        self.trackpoints_file.close()
+        for file_name in (self.trackpoints_file_name, self.file_name + '.tmp'):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
 def parse_gpx_to_untrimmed_df(gpx_filename = None):
     if (gpx_filename is None):
         return None
+    if not isinstance(gpx_filename, str):
+        # Several gpx files are merged in a single dataframe
+        gpx_dfs = [gpx_df for gpx_df in map(parse_gpx_to_untrimmed_df, gpx_filename) if gpx_df is not None]
+        if len(gpx_dfs) == 0:
+            return None
+        gpx_df = pd.concat(gpx_dfs)
+        gpx_df = gpx_df[~gpx_df.index.duplicated(keep='first')]
+        gpx_df.sort_index(inplace=True)
+        return gpx_df
     
     # Obtain gpx file
     try:
@@ -585,7 +892,7 @@ def parse_gpx_to_untrimmed_df(gpx_filename = None):
     gpx_df.sort_index(inplace=True)
     return gpx_df
     
-def create_loc_df(gpx_untr_df = None, starttime_ts = None, endtime_ts = None):
+def create_loc_df(gpx_untr_df = None, starttime_ts = None, endtime_ts = None, do_not_update_distance = False):
     if (gpx_untr_df is None) or (starttime_ts is None) or (endtime_ts is None):
         return None
     
@@ -621,37 +928,1016 @@ def create_loc_df(gpx_untr_df = None, starttime_ts = None, endtime_ts = None):
         tcx_df['elevation'].bfill(inplace=True)
     tcx_df = tcx_df[(tcx_df.index >= tcx_startdate) & (tcx_df.index <= tcx_enddate)]
 
-    if not DO_NOT_UPDATE_DISTANCE:
+    if not do_not_update_distance:
         # Calculate distances and cumul distances
         tcx_df[['lat_prev', 'lon_prev', 'ele_prev']] = tcx_df[['latitude', 'longitude', 'elevation']].shift(1)
         tcx_df.loc[tcx_df.index[0], 'lat_prev'] = tcx_df.loc[tcx_df.index[0], 'latitude']
         tcx_df.loc[tcx_df.index[0], 'lon_prev'] = tcx_df.loc[tcx_df.index[0], 'longitude']
         tcx_df.loc[tcx_df.index[0], 'ele_prev'] = tcx_df.loc[tcx_df.index[0], 'elevation']
-        tcx_df['dist'] = tcx_df.apply(lambda r: gpxpy.geo.distance(r['lat_prev'], r['lon_prev'], r['ele_prev'] if pd.notna(r['ele_prev']) else None,
-                                    r['latitude'], r['longitude'], r['elevation'] if pd.notna(r['elevation']) else None),
-                                    axis=1)
+        tcx_df['dist'] = geo_distances(tcx_df['lat_prev'].to_numpy(dtype=float), tcx_df['lon_prev'].to_numpy(dtype=float),
+                                       tcx_df['ele_prev'].to_numpy(dtype=float), tcx_df['latitude'].to_numpy(dtype=float),
+                                       tcx_df['longitude'].to_numpy(dtype=float), tcx_df['elevation'].to_numpy(dtype=float))
         tcx_df['cumul_dist'] = tcx_df['dist'].cumsum()
         #total_dist = tcx_df['cumul_dist'].iloc[-1]
         #print(f"Total distance (GPX): {total_dist}")
     
     return tcx_df
 
-def main():
-    global USE_KEYRING
-    global EXPORT_ALL_WORKOUTS
-    global EXPORT_ONE_WORKOUT
-    global INCLUDE_AUTODETECTED_WORKOUTS
-    global GPX_FILENAME
-    global DO_NOT_UPDATE_DISTANCE
+def iter_loc_chunks(gpx_untr_df = None, starttime_ts = None, endtime_ts = None, chunk_seconds = None, do_not_update_distance = False):
+    # Same rows and values as create_loc_df, produced in consecutive chunks of chunk_seconds seconds
+    # Returns None, like create_loc_df, when the gpx data does not cover the workout
+    if (gpx_untr_df is None) or (starttime_ts is None) or (endtime_ts is None):
+        return None
 
+    total_duration = endtime_ts - starttime_ts + 1
+    tcx_startdate = pd.Timestamp(starttime_ts, unit='s', tz='UTC')
+    tcx_enddate = pd.Timestamp(starttime_ts + total_duration - 1, unit='s', tz='UTC')
+
+    # Trim gpx dataframe to include only timepoints in tcx plus one extra at start and end 
+    tmp_series = gpx_untr_df.index[gpx_untr_df.index <= tcx_startdate]
+    gpx_from = tmp_series[-1] if len(tmp_series) > 0 else None
+    tmp_series = gpx_untr_df.index[gpx_untr_df.index >= tcx_enddate]
+    gpx_to = tmp_series[0] if len(tmp_series) > 0 else None
+    if (gpx_from is None) or (gpx_to is None):
+        return None
+
+    gpx_df = gpx_untr_df[ (gpx_untr_df.index >= gpx_from) & (gpx_untr_df.index <= gpx_to) ]
+    gpx_df.index = pd.to_datetime(gpx_df.index, utc=True)
+    gpx_df = gpx_df[~gpx_df.index.duplicated(keep='first')]
+    gpx_df = gpx_df.sort_index(ascending=True)
+    anchors = {col: gpx_df[col].dropna() for col in ['latitude', 'longitude', 'elevation']}
+
+    def loc_chunks():
+        # Last row of the previous chunk, to compute the distance to the first row of the next one
+        prev_row = None
+        running_dist = 0.0
+        for chunk_start in range(0, total_duration, chunk_seconds):
+            periods = min(chunk_seconds, total_duration - chunk_start)
+            tcx_df = pd.date_range(start=timestamp_to_iso8601(starttime_ts + chunk_start), freq='1s', periods=periods).to_frame()
+            tcx_df[['latitude', 'longitude', 'elevation']] = np.nan
+            chunk_gpx_df = gpx_df[(gpx_df.index >= tcx_df.index[0]) & (gpx_df.index <= tcx_df.index[-1])]
+
+            # If tcx contained positional data, it will be ignored
+            tcx_df = pd.concat([chunk_gpx_df, tcx_df])
+            tcx_df = tcx_df[~tcx_df.index.duplicated(keep='first')]
+            tcx_df = tcx_df.sort_index(ascending=True)
+            x = tcx_df.index.asi8
+            for col in ['latitude', 'longitude', 'elevation']:
+                tcx_df[col] = interpolate_from(tcx_df[col], x, anchors[col])
+
+            if not do_not_update_distance:
+                # Calculate distances and cumul distances
+                tcx_df[['lat_prev', 'lon_prev', 'ele_prev']] = tcx_df[['latitude', 'longitude', 'elevation']].shift(1)
+                if prev_row is None:
+                    prev_row = tcx_df[['latitude', 'longitude', 'elevation']].iloc[0]
+                tcx_df.loc[tcx_df.index[0], ['lat_prev', 'lon_prev', 'ele_prev']] = prev_row.to_numpy()
+                tcx_df['dist'] = geo_distances(tcx_df['lat_prev'].to_numpy(dtype=float), tcx_df['lon_prev'].to_numpy(dtype=float),
+                                               tcx_df['ele_prev'].to_numpy(dtype=float), tcx_df['latitude'].to_numpy(dtype=float),
+                                               tcx_df['longitude'].to_numpy(dtype=float), tcx_df['elevation'].to_numpy(dtype=float))
+                # Cumulative sum carried over chunks, skipping missing distances as pandas cumsum does
+                dist = tcx_df['dist'].to_numpy()
+                cumul_dist = np.cumsum(np.r_[running_dist, np.nan_to_num(dist, nan=0.0)])[1:]
+                running_dist = cumul_dist[-1]
+                cumul_dist[np.isnan(dist)] = np.nan
+                tcx_df['cumul_dist'] = cumul_dist
+                prev_row = tcx_df[['latitude', 'longitude', 'elevation']].iloc[-1]
+
+            yield tcx_df
+
+    return loc_chunks()
+
+def geo_distances(lat_prev, lon_prev, ele_prev, lat, lon, ele):
+    # Vectorized version of gpxpy.geo.distance over numpy arrays: flat approximation for close points
+    # (3d if both elevations are known), haversine for distant ones
+    coef = np.cos(np.radians(lat_prev))
+    x = lat_prev - lat
+    y = (lon_prev - lon) * coef
+    distance_2d = np.sqrt(x * x + y * y) * gpxpy.geo.ONE_DEGREE
+    delta_ele = ele_prev - ele
+    distance = np.where(np.isnan(delta_ele), distance_2d, np.sqrt(distance_2d ** 2 + delta_ele ** 2))
+
+    d_lon = np.radians(lon_prev - lon)
+    lat1 = np.radians(lat_prev)
+    lat2 = np.radians(lat)
+    a = np.sin((lat1 - lat2) / 2) ** 2 + np.sin(d_lon / 2) ** 2 * np.cos(lat1) * np.cos(lat2)
+    haversine = 2 * gpxpy.geo.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    far = (np.abs(lat_prev - lat) > .2) | (np.abs(lon_prev - lon) > .2)
+    return np.where(far, haversine, distance)
+
+def read_tcx_trackpoints(tcx_filename):
+    # Parse a tcx file in a single streaming pass, collecting trackpoints and their times in document order
+    # Returns the tree, the trackpoint elements, their times (unix seconds), for each lap the lap
+    # element with the index of its first trackpoint and its number of trackpoints, and the
+    # (prefix, uri) namespace declarations of the file
+    trackpoints = []
+    times = []
+    laps = []
+    namespaces = []
+    lap_start = 0
+    context = ET.iterparse(tcx_filename, events=('start-ns', 'end'))
+    for event, elem in context:
+        if event == 'start-ns':
+            namespaces.append(elem)
+        elif elem.tag == TCX_TAG + 'Trackpoint':
+            time_elt = elem.find(TCX_TAG + 'Time')
+            trackpoints.append(elem)
+            times.append(time_elt.text if time_elt is not None else None)
+        elif elem.tag == TCX_TAG + 'Lap':
+            laps.append((elem, lap_start, len(trackpoints) - lap_start))
+            lap_start = len(trackpoints)
+    times = pd.to_datetime(pd.Series(times, dtype=object), utc=True)
+    times = (times - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+    return ET.ElementTree(context.root), trackpoints, times, laps, namespaces
+
+def use_original_prefixes(root, namespaces):
+    # Write qualified names with the prefixes declared in the parsed file, and declare them on the root,
+    # so that rewritten files keep their prefixes without registering them globally in ElementTree
+    prefixes = {}
+    for prefix, uri in namespaces:
+        prefixes.setdefault('{' + uri + '}', prefix)
+
+    def prefixed(name, is_attribute = False):
+        if name[:1] != '{':
+            return name
+        uri, local_name = name[:name.index('}') + 1], name[name.index('}') + 1:]
+        prefix = prefixes.get(uri)
+        # Attributes without prefix are in no namespace, so they can not use the default one
+        if prefix is None or (prefix == '' and is_attribute):
+            return name
+        return local_name if prefix == '' else prefix + ':' + local_name
+
+    for elt in root.iter():
+        elt.tag = prefixed(elt.tag)
+        if any(key[:1] == '{' for key in elt.attrib):
+            elt.attrib = {prefixed(key, True): value for key, value in elt.attrib.items()}
+    declarations = {('xmlns:' + prefix if prefix else 'xmlns'): uri[1:-1] for uri, prefix in prefixes.items()}
+    root.attrib = dict(declarations, **root.attrib)
+
+def align_gpx(gpx_untr_df, times):
+    # Interpolate gpx positions at the given unix times
+    # Times outside the gpx track get no position, elevation is extended from the closest known value
+    gpx_df = gpx_untr_df[~gpx_untr_df.index.duplicated(keep='first')]
+    gpx_times = (pd.to_datetime(gpx_df.index, utc=True) - pd.Timestamp(0, tz='UTC')).total_seconds().to_numpy()
+    lat = np.interp(times, gpx_times, gpx_df['latitude'].to_numpy(dtype=float), left=np.nan, right=np.nan)
+    lon = np.interp(times, gpx_times, gpx_df['longitude'].to_numpy(dtype=float), left=np.nan, right=np.nan)
+    gpx_ele = gpx_df['elevation'].to_numpy(dtype=float)
+    known_ele = ~np.isnan(gpx_ele)
+    ele = np.full(len(times), np.nan)
+    if known_ele.any():
+        ele = np.interp(times, gpx_times[known_ele], gpx_ele[known_ele])
+    ele[np.isnan(lat)] = np.nan
+    return lat, lon, ele
+
+def enrich_tcx_file(tcx_filename, output_filename, gpx_untr_df, do_not_update_distance = False):
+    # Add gpx positions to an existing tcx file; returns the number of trackpoints with position
+    # Files without any position are copied as they are when written to a different output file
+    tree, trackpoints, times, laps, namespaces = read_tcx_trackpoints(tcx_filename)
+    located = np.zeros(0, dtype=bool)
+    if len(trackpoints) > 0:
+        lat, lon, ele = align_gpx(gpx_untr_df, times)
+        located = ~np.isnan(lat) & ~np.isnan(lon)
+    if not located.any():
+        if os.path.abspath(output_filename) != os.path.abspath(tcx_filename):
+            os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+            shutil.copyfile(tcx_filename, output_filename)
+        return 0
+
+    if not do_not_update_distance:
+        # Cumulative distance along located trackpoints, carried over the ones without position
+        idx = np.flatnonzero(located)
+        dist = geo_distances(lat[idx][np.r_[0, :len(idx) - 1]], lon[idx][np.r_[0, :len(idx) - 1]],
+                             ele[idx][np.r_[0, :len(idx) - 1]], lat[idx], lon[idx], ele[idx])
+        cumul_dist = np.zeros(len(trackpoints))
+        cumul_dist[idx] = np.cumsum(dist)
+        cumul_dist = np.maximum.accumulate(cumul_dist)
+
+    # If tcx contained positional data, it will be replaced
+    for i, tkp_elt in enumerate(trackpoints):
+        if located[i]:
+            for old_elt in tkp_elt.findall(TCX_TAG + 'Position') + tkp_elt.findall(TCX_TAG + 'AltitudeMeters'):
+                tkp_elt.remove(old_elt)
+            pos_elt = ET.Element(TCX_TAG + 'Position')
+            tkp_elt.insert(1, pos_elt)
+            lat_elt = ET.SubElement(pos_elt, TCX_TAG + 'LatitudeDegrees')
+            lat_elt.text = str(lat[i])
+            lon_elt = ET.SubElement(pos_elt, TCX_TAG + 'LongitudeDegrees')
+            lon_elt.text = str(lon[i])
+            if not np.isnan(ele[i]):
+                alt_elt = ET.Element(TCX_TAG + 'AltitudeMeters')
+                tkp_elt.insert(2, alt_elt)
+                alt_elt.text = str(ele[i])
+        if not do_not_update_distance:
+            dist_elt = tkp_elt.find(TCX_TAG + 'DistanceMeters')
+            if dist_elt is not None:
+                dist_elt.text = str(cumul_dist[i])
+
+    if not do_not_update_distance:
+        for lap_elt, first, count in laps:
+            dist_elt = lap_elt.find(TCX_TAG + 'DistanceMeters')
+            if dist_elt is not None and count > 0:
+                lap_start_dist = cumul_dist[first - 1] if first > 0 else 0.0
+                dist_elt.text = str(cumul_dist[first + count - 1] - lap_start_dist)
+
+    # Write to a temporary file first so the input is never left half written when enriching in place
+    use_original_prefixes(tree.getroot(), namespaces)
+    os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+    tmp_filename = output_filename + '.tmp'
+    tree.write(tmp_filename,
+               xml_declaration=True,
+               encoding='UTF-8',
+               method='xml',
+               short_empty_elements=False)
+    os.replace(tmp_filename, output_filename)
+    return int(located.sum())
+
+def init_enrich_worker(gpx_untr_df):
+    # Each worker process receives the gpx dataframe once instead of with every file
+    global ENRICH_GPX_DF
+    ENRICH_GPX_DF = gpx_untr_df
+
+def enrich_tcx_file_worker(tcx_filename, output_filename, do_not_update_distance):
+    return enrich_tcx_file(tcx_filename, output_filename, ENRICH_GPX_DF, do_not_update_distance)
+
+def enrich_tcx_dir(tcx_dir, gpx_untr_df, output_dir = None, do_not_update_distance = False, max_workers = None):
+    # Add gpx positions to all tcx files under tcx_dir, processing files in parallel
+    # Enriched files go to output_dir (keeping relative paths) or replace the originals if output_dir is None
+    # When replacing them, the hashes in the manifest of tcx_dir (if any) are updated
+    manifest_filename = os.path.join(tcx_dir, MANIFEST_FILENAME)
+    manifest = Manifest(manifest_filename) if output_dir is None and os.path.isfile(manifest_filename) else None
+    tcx_filenames = sorted(os.path.join(dirpath, filename)
+                           for dirpath, dirnames, filenames in os.walk(tcx_dir)
+                           for filename in filenames if filename.lower().endswith('.tcx'))
+    print(f"Enriching {len(tcx_filenames)} tcx files in {tcx_dir}")
+    enriched = 0
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_enrich_worker, initargs=(gpx_untr_df,)) as pool:
+        futures = {}
+        for tcx_filename in tcx_filenames:
+            output_filename = tcx_filename
+            if output_dir is not None:
+                output_filename = os.path.join(output_dir, os.path.relpath(tcx_filename, tcx_dir))
+            futures[pool.submit(enrich_tcx_file_worker, tcx_filename, output_filename, do_not_update_distance)] = tcx_filename
+        for future in as_completed(futures):
+            try:
+                located = future.result()
+            except Exception as e:
+                print(f"Error: cannot enrich {futures[future]}: {e!r}")
+                continue
+            if located > 0:
+                enriched += 1
+                print(f"{futures[future]}: {located} trackpoints with position")
+                if manifest is not None:
+                    manifest.update_sha256(futures[future])
+    if manifest is not None:
+        manifest.close()
+    print(f"Enriched {enriched} of {len(tcx_filenames)} tcx files")
+    return enriched
+
+def subscribe_notifications(notify_url, access_token, callback_url, session = SESSION):
+    # Ask Withings to POST activity notifications to callback_url
+    # Withings checks that callback_url is reachable before accepting the subscription
+    headers = {'Authorization': f'Bearer {access_token}'}
+    params = {
+        'action': 'subscribe',
+        'callbackurl': callback_url,
+        'appli': NOTIFY_APPLI_ACTIVITY,
+        'comment': 'ActivityDL'
+    }
+    response = session.post(notify_url, headers=headers, params=params).json()
+    if response['status'] != 0:
+        print(f"Error: {response}")
+        return False
+    print(f"Subscribed to activity notifications at {callback_url}")
+    return True
+
+def start_notification_server(listen_port, notifications):
+    # Receive Withings notifications via a web server running in a background thread
+    # Each notification is put in the notifications queue as a dict of its form parameters
+    class Handler(BaseHTTPRequestHandler):
+        def reply_ok(self):
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain')
+            self.end_headers()
+        def do_HEAD(self):
+            # Withings probes the callback url when subscribing
+            self.reply_ok()
+        def do_GET(self):
+            self.reply_ok()
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            # Answer immediately, Withings expects a quick response
+            self.reply_ok()
+            notification = {k: v[0] for k, v in parse_qs(body).items()}
+            if notification.get('appli') == NOTIFY_APPLI_ACTIVITY:
+                notifications.put(notification)
+        def log_message(self, format, *args):
+            pass
+
+    httpd = HTTPServer(('0.0.0.0', int(listen_port)), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, args=())
+    thread.daemon = True
+    thread.start()
+    print(f"Listening for notifications on port {listen_port}")
+    return httpd
+
+def simulate_notification(listen_port, startdate, enddate):
+    # Send a fake activity notification to a running watcher, as Withings would do
+    data = {
+        'userid': '0',
+        'appli': NOTIFY_APPLI_ACTIVITY,
+        'startdate': startdate,
+        'enddate': enddate
+    }
+    response = requests.post(f'http://localhost:{listen_port}', data=data)
+    print(f"Notification from {datetime.fromtimestamp(startdate)} to {datetime.fromtimestamp(enddate)} sent. Status: {response.status_code}")
+
+def create_samples_table(workout, samples_df, loc_df = None):
+    # Per-second samples of a workout as an arrow table with compact dtypes, keyed by workout id
+    # Raw intraday values are kept only at the seconds Withings reported them, resampled ones at every second
+    table_df = pd.DataFrame(index=samples_df.index)
+    table_df['workout_id'] = np.int64(workout['id'])
+    table_df['time'] = samples_df.index
+    table_df['real'] = samples_df['rs'] == 'Real'
+    table_df['heart_rate'] = samples_df['heart_rate'].round().astype('UInt8')
+    table_df['cadence'] = samples_df['cadence'].astype('float32')
+    table_df['cumul_distance'] = samples_df['distance_tcx'].astype('float32')
+    for field, dtype in SAMPLE_FIELD_DTYPES.items():
+        values = pd.Series(np.nan, index=table_df.index)
+        if field in samples_df.columns:
+            values = pd.to_numeric(samples_df[field], errors='coerce')
+        if dtype.startswith('UInt'):
+            values = values.round()
+        table_df[field] = values.astype(dtype)
+    location = loc_df.reindex(table_df.index) if loc_df is not None else pd.DataFrame(index=table_df.index)
+    table_df['latitude'] = location.get('latitude', np.nan)
+    table_df['longitude'] = location.get('longitude', np.nan)
+    table_df['altitude'] = pd.Series(location.get('elevation', np.nan), index=table_df.index).astype('float32')
+    table = pa.Table.from_pandas(table_df, preserve_index=False)
+    # Parquet has no seconds resolution, milliseconds is the most compact one
+    return table.set_column(1, 'time', table['time'].cast(pa.timestamp('ms', tz='UTC')))
+
+def create_workout_table(workout):
+    # getworkouts summary of a workout as a one row arrow table
+    data = workout.get('data', {})
+    columns = {
+        'workout_id': pa.array([workout['id']], pa.int64()),
+        'category': pa.array([workout.get('category')], pa.uint16()),
+        'attrib': pa.array([workout.get('attrib')], pa.uint8()),
+        'model': pa.array([workout.get('model')], pa.uint16()),
+        'deviceid': pa.array([workout.get('deviceid')], pa.string()).dictionary_encode(),
+        'timezone': pa.array([workout.get('timezone')], pa.string()).dictionary_encode(),
+        'startdate': pa.array([workout['startdate']], pa.timestamp('s', tz='UTC')).cast(pa.timestamp('ms', tz='UTC')),
+        'enddate': pa.array([workout['enddate']], pa.timestamp('s', tz='UTC')).cast(pa.timestamp('ms', tz='UTC')),
+        'modified': pa.array([workout.get('modified')], pa.timestamp('s', tz='UTC')).cast(pa.timestamp('ms', tz='UTC')),
+    }
+    for field in WORKOUT_DATA_FIELDS.split(','):
+        columns[field] = pa.array([data.get(field)], pa.float32())
+    return pa.table(columns)
+
+class ParquetSink(object):
+    # Adds a workout to the 'samples' and 'workouts' datasets under parquet_dir, both partitioned by
+    # year and month of the workout start (hive style); each workout is one file named after its id,
+    # so exporting a workout again replaces its data
+    # Samples can be written in several chunks, each one becomes a row group of the samples file
+    # The workout summary is only written on close, so abort() leaves nothing behind
+    def __init__(self, parquet_dir, workout) -> None:
+        self.workout = workout
+        start = datetime.fromtimestamp(workout['startdate'], tz=timezone.utc)
+        partition = os.path.join(f"year={start.year}", f"month={start.month:02d}")
+        file_name = f"{workout['id']}.parquet"
+        self.workouts_dir = os.path.join(parquet_dir, 'workouts', partition)
+        self.workouts_file_name = os.path.join(self.workouts_dir, file_name)
+        samples_dir = os.path.join(parquet_dir, 'samples', partition)
+        os.makedirs(samples_dir, exist_ok=True)
+        self.samples_file_name = os.path.join(samples_dir, file_name)
+        self.writer = None
+
+    def write(self, samples_df, loc_df = None):
+        table = create_samples_table(self.workout, samples_df, loc_df)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.samples_file_name + '.tmp', table.schema, compression='zstd')
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.samples_file_name + '.tmp', self.samples_file_name)
+        os.makedirs(self.workouts_dir, exist_ok=True)
+        pq.write_table(create_workout_table(self.workout), self.workouts_file_name, compression='zstd')
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.samples_file_name + '.tmp'):
+            os.remove(self.samples_file_name + '.tmp')
+
+def write_parquet(parquet_dir, workout, samples_df, loc_df = None):
+    sink = ParquetSink(parquet_dir, workout)
+    try:
+        sink.write(samples_df, loc_df)
+        sink.close()
+    except BaseException:
+        sink.abort()
+        raise
+
+def file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class Manifest(object):
+    # SQLite index of the exported workouts, updated on each write, so that lookups and
+    # "already exported?" checks do not need to list and parse the exported files
+    # Paths are stored relative to the directory of the manifest
+    COLUMNS = ['id', 'startdate', 'enddate', 'modified', 'category', 'attrib', 'model', 'deviceid',
+               'duration', 'distance', 'calories', 'hr_average', 'hr_min', 'hr_max', 'path', 'sha256']
+
+    def __init__(self, filename) -> None:
+        self.filename = filename
+        self.base_dir = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS workouts (
+                id INTEGER PRIMARY KEY, startdate INTEGER, enddate INTEGER, modified INTEGER,
+                category INTEGER, attrib INTEGER, model INTEGER, deviceid TEXT,
+                duration REAL, distance REAL, calories REAL, hr_average REAL, hr_min REAL, hr_max REAL,
+                path TEXT, sha256 TEXT, exported INTEGER)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS workouts_startdate ON workouts (startdate)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS workouts_category ON workouts (category, startdate)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS workouts_deviceid ON workouts (deviceid, startdate)')
+
+    def record(self, workout, file_name):
+        # Add or replace the entry of a workout just written to file_name
+        data = workout.get('data', {})
+        row = (workout['id'], workout['startdate'], workout['enddate'], workout.get('modified'),
+               workout.get('category'), workout.get('attrib'), workout.get('model'), workout.get('deviceid'),
+               float(workout['enddate'] - workout['startdate'] + 1), data.get('distance'), data.get('calories'),
+               data.get('hr_average'), data.get('hr_min'), data.get('hr_max'),
+               os.path.relpath(os.path.abspath(file_name), self.base_dir), file_sha256(file_name), int(time.time()))
+        with self.lock, self.db:
+            self.db.execute(f'INSERT OR REPLACE INTO workouts VALUES ({",".join("?" * len(row))})', row)
+
+    def update_sha256(self, file_name):
+        # Refresh the hash of an exported file rewritten in place; returns False if it is not in the manifest
+        path = os.path.relpath(os.path.abspath(file_name), self.base_dir)
+        with self.lock, self.db:
+            return self.db.execute('UPDATE workouts SET sha256 = ? WHERE path = ?', (file_sha256(file_name), path)).rowcount > 0
+
+    def is_exported(self, workout):
+        # True if this version of the workout (same id and modification time) was exported and its file still exists
+        with self.lock:
+            row = self.db.execute('SELECT modified, path FROM workouts WHERE id = ?', (workout['id'],)).fetchone()
+        return (row is not None and row['modified'] == workout.get('modified')
+                and os.path.isfile(os.path.join(self.base_dir, row['path'])))
+
+    def find(self, since = None, until = None, category = None, deviceid = None):
+        # Exported workouts matching all the given filters, ordered by startdate
+        conditions, params = [], []
+        for condition, value in (('startdate >= ?', since), ('startdate <= ?', until),
+                                 ('category = ?', category), ('deviceid = ?', deviceid)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = f'SELECT {", ".join(self.COLUMNS)} FROM workouts'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock:
+            return [dict(row) for row in self.db.execute(query + ' ORDER BY startdate, id', params)]
+
+    def close(self):
+        self.db.close()
+
+class JobQueue(object):
+    # SQLite queue of workouts to export, so that an interrupted or partially failed run resumes where
+    # it stopped: each workout is a job that goes from 'pending' to 'fetched' (its intraday details are
+    # stored) and to 'written', or to 'failed' with the number of attempts and the last error
+    # Paths are stored relative to the directory of the queue
+    STATES = ['pending', 'fetched', 'written', 'failed']
+
+    def __init__(self, filename) -> None:
+        self.filename = filename
+        self.base_dir = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY, startdate INTEGER, modified INTEGER, workout TEXT, state TEXT,
+                attempts INTEGER, last_error TEXT, details TEXT, path TEXT, updated INTEGER)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, startdate)')
+
+    def add(self, workouts):
+        # Queue workouts as pending jobs; a job already queued is kept as it is, unless the workout was
+        # modified since or its file was deleted after being written
+        with self.lock, self.db:
+            for wk in workouts:
+                row = self.db.execute('SELECT modified, state, path FROM jobs WHERE id = ?', (wk['id'],)).fetchone()
+                if (row is not None and row['modified'] == wk.get('modified')
+                        and not (row['state'] == 'written' and not os.path.isfile(os.path.join(self.base_dir, row['path'])))):
+                    continue
+                self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, 0, NULL, NULL, NULL, ?)',
+                                (wk['id'], wk['startdate'], wk.get('modified'), json.dumps(wk), 'pending', int(time.time())))
+
+    def is_written(self, workout):
+        # True if this version of the workout was written and its file still exists
+        with self.lock:
+            row = self.db.execute('SELECT modified, state, path FROM jobs WHERE id = ?', (workout['id'],)).fetchone()
+        return (row is not None and row['modified'] == workout.get('modified') and row['state'] == 'written'
+                and os.path.isfile(os.path.join(self.base_dir, row['path'])))
+
+    def gave_up(self, workout, max_attempts = JOB_MAX_ATTEMPTS):
+        # True if this version of the workout already failed max_attempts times
+        with self.lock:
+            row = self.db.execute('SELECT modified, state, attempts FROM jobs WHERE id = ?', (workout['id'],)).fetchone()
+        return (row is not None and row['modified'] == workout.get('modified') and row['state'] == 'failed'
+                and row['attempts'] >= max_attempts)
+
+    def unfinished(self, max_attempts = JOB_MAX_ATTEMPTS):
+        # Workouts of the jobs still to run, ordered by startdate: pending, fetched, and failed fewer than max_attempts times
+        with self.lock:
+            rows = self.db.execute('''SELECT workout FROM jobs WHERE state IN ('pending', 'fetched')
+                                      OR (state = 'failed' AND attempts < ?) ORDER BY startdate, id''', (max_attempts,)).fetchall()
+        return [json.loads(row['workout']) for row in rows]
+
+    def retry_failed(self):
+        # Give the failed jobs a new set of attempts
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET attempts = 0 WHERE state = 'failed'")
+
+    def details(self, workout):
+        # Intraday details stored when the job was fetched, or None
+        with self.lock:
+            row = self.db.execute('SELECT details FROM jobs WHERE id = ?', (workout['id'],)).fetchone()
+        return json.loads(row['details']) if row is not None and row['details'] is not None else None
+
+    def fetched(self, workout, details):
+        self.update(workout['id'], "state = 'fetched', details = ?", json.dumps(details))
+
+    def written(self, workout, file_name):
+        # Details are not needed any more once the files are written
+        self.update(workout['id'], "state = 'written', details = NULL, last_error = NULL, path = ?",
+                    os.path.relpath(os.path.abspath(file_name), self.base_dir))
+
+    def failed(self, workout, error):
+        self.update(workout['id'], "state = 'failed', attempts = attempts + 1, last_error = ?", error)
+
+    def update(self, job_id, assignments, value):
+        with self.lock, self.db:
+            self.db.execute(f'UPDATE jobs SET {assignments}, updated = ? WHERE id = ?', (value, int(time.time()), job_id))
+
+    def counts(self):
+        # Number of jobs in each state
+        with self.lock:
+            rows = self.db.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state').fetchall()
+        counts = dict.fromkeys(self.STATES, 0)
+        counts.update((row['state'], row['n']) for row in rows)
+        return counts
+
+    def close(self):
+        self.db.close()
+
+class Exporter(object):
+    # Exports the workouts of one Withings account with its own configuration and tokens
+    # Several exporters can live in the same process; they share the HTTP connection pool
+    # and the accounts of the same client id share its rate limiter
+    def __init__(self, client_id, client_secret, token_store = None, name = None,
+                 include_autodetected = False, gpx_filename = None, do_not_update_distance = False,
+                 output_dir = '.', output_layout = 'flat', use_manifest = False, skip_exported = False,
+                 parquet_dir = None, chunk_seconds = None, use_queue = False, callback_port = '8000',
+                 calls_per_minute = None, session = SESSION) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_store = token_store if token_store is not None else KeyringTokenStore(name)
+        self.name = name
+        self.include_autodetected = include_autodetected
+        self.do_not_update_distance = do_not_update_distance
+        self.output_dir = output_dir
+        # 'flat' writes all files in output_dir, 'partitioned' in output_dir/YYYY/MM
+        self.output_layout = output_layout
+        self.manifest = Manifest(os.path.join(output_dir, MANIFEST_FILENAME)) if use_manifest or skip_exported else None
+        self.skip_exported = skip_exported
+        if parquet_dir is not None and pq is None:
+            raise ImportError("pyarrow is needed to write parquet files")
+        self.parquet_dir = parquet_dir
+        # Workouts are resampled and written chunk_seconds at a time, or all at once if None
+        self.chunk_seconds = chunk_seconds
+        # With a job queue, a failed workout is recorded and the others go on, instead of stopping the run
+        self.jobs = JobQueue(os.path.join(output_dir, JOBS_FILENAME)) if use_queue else None
+        self.callback_port = str(callback_port)
+        self.redirect_url = 'http://localhost:' + self.callback_port
+        self.session = AccountSession(session, client_id, calls_per_minute)
+        self.gpx_untrimmed_df = parse_gpx_to_untrimmed_df(gpx_filename)
+        self.access_token = None
+        self.refresh_token = None
+        self.token_time = 0.0
+        self.token_lock = threading.Lock()
+        # Outputs written for each workout, which decide the fields requested to Withings
+        self.outputs = ['tcx']
+        if self.manifest is not None: self.outputs.append('manifest')
+        if self.parquet_dir is not None: self.outputs.append('parquet')
+        self.workout_fields = plan_workout_fields(self.outputs)
+
+    def authenticate(self):
+        # Check if refresh_token exists and is valid
+        access_token = None
+        refresh_token = self.token_store.load()
+        if refresh_token is not None:
+            access_token, refresh_token = get_access_tokens_refresh(TOKEN_URL, self.client_id, self.client_secret,
+                                                                    refresh_token, self.session)
+        if access_token is None:
+            # Need to get authorization code
+            auth_code = get_authorization_code(AUTH_URL, self.client_id, self.redirect_url, self.callback_port)
+            access_token, refresh_token = get_access_tokens_auth(TOKEN_URL, self.client_id, self.client_secret,
+                                                                 self.redirect_url, auth_code, self.session)
+        if access_token is None:
+            raise WithingsAPIError("could not get access tokens")
+        self.token_store.save(refresh_token)
+        self.access_token, self.refresh_token = access_token, refresh_token
+        self.token_time = time.time()
+        return access_token
+
+    def get_access_token(self):
+        # Return a valid access token, refreshing it when it is about to expire
+        with self.token_lock:
+            if self.access_token is None:
+                return self.authenticate()
+            if time.time() - self.token_time > ACCESS_TOKEN_LIFETIME:
+                access_token, refresh_token = get_access_tokens_refresh(TOKEN_URL, self.client_id, self.client_secret,
+                                                                        self.refresh_token, self.session)
+                if access_token is not None:
+                    self.access_token, self.refresh_token = access_token, refresh_token
+                    self.token_store.save(refresh_token)
+                    self.token_time = time.time()
+            return self.access_token
+
+    def get_workouts_since(self, from_date):
+        return get_all_workouts_since(API_URL, self.get_access_token(), from_date,
+                                      self.include_autodetected, self.session, self.workout_fields)
+
+    def get_workouts_between(self, startdateymd, enddateymd, access_token = None):
+        return get_workouts_between(API_URL, access_token or self.get_access_token(), startdateymd, enddateymd,
+                                    self.include_autodetected, self.session, self.workout_fields)
+
+    def get_workouts_for_notification(self, notification):
+        startdate = int(notification['startdate'])
+        enddate = int(notification['enddate'])
+        workouts = self.get_workouts_since(startdate - NOTIFY_LOOKBACK)
+        # Keep only workouts overlapping the notified interval
+        return [wk for wk in workouts if wk['startdate'] <= enddate and wk['enddate'] >= startdate]
+
+    def fetch_details(self, workout):
+        data_fields = plan_intraday_fields(workout.get('category'), self.outputs)
+        return get_intradayactivity(API_URL, self.get_access_token(), workout['startdate'], workout['enddate'],
+                                    self.session, data_fields)
+
+    def print_stats(self):
+        prefix = f"{self.name}: " if self.name is not None else ""
+        print(f"{prefix}Received {self.session.bytes_received / 1024:.1f} kB from Withings")
+
+    def workout_file_name(self, workout):
+        start = datetime.fromtimestamp(workout['startdate'], tz=timezone.utc)
+        file_name = ''.join([timestamp_to_filename(workout['startdate']), '.tcx'])
+        if self.output_layout == 'partitioned':
+            return os.path.join(self.output_dir, start.strftime('%Y'), start.strftime('%m'), file_name)
+        return os.path.join(self.output_dir, file_name)
+
+    def is_exported(self, workout):
+        return self.skip_exported and self.manifest is not None and self.manifest.is_exported(workout)
+
+    def write_workout(self, workout, act_details):
+        tcx_file_name = self.workout_file_name(workout)
+        print(f"Workout has {len(act_details)} detailed entries. Filename: {tcx_file_name}")
+        if self.chunk_seconds is not None:
+            return self.write_workout_chunked(workout, act_details, tcx_file_name)
+
+        gpx_df = create_loc_df(self.gpx_untrimmed_df, int(workout['startdate']), int(workout['enddate']),
+                               self.do_not_update_distance)
+
+        samples_df = resample_details(workout, act_details)
+        tcx = create_tcx(workout, act_details, gpx_df, self.do_not_update_distance, samples_df)
+        #ET.indent(tcx)
+        #ET.dump(tcx)
+        os.makedirs(os.path.dirname(tcx_file_name), exist_ok=True)
+        ET.ElementTree(tcx).write(tcx_file_name,
+                                  xml_declaration=True,
+                                  encoding='UTF-8',
+                                  method='xml',
+                                  short_empty_elements=False)
+        if self.parquet_dir is not None:
+            write_parquet(self.parquet_dir, workout, samples_df, gpx_df)
+        if self.manifest is not None:
+            self.manifest.record(workout, tcx_file_name)
+        return tcx_file_name
+
+    def write_workout_chunked(self, workout, act_details, tcx_file_name):
+        # Same output as write_workout, but never holds more than chunk_seconds of resampled
+        # samples (and location) in memory, for very long workouts
+        loc_chunks = iter_loc_chunks(self.gpx_untrimmed_df, int(workout['startdate']), int(workout['enddate']),
+                                     self.chunk_seconds, self.do_not_update_distance)
+        if loc_chunks is None:
+            loc_chunks = itertools.repeat(None)
+
+        os.makedirs(os.path.dirname(tcx_file_name), exist_ok=True)
+        sinks = []
+        # On any error the sinks remove their temporary files, so failed workouts leave nothing behind
+        try:
+            sinks.append(ChunkedTcxWriter(tcx_file_name, workout, self.do_not_update_distance))
+            if self.parquet_dir is not None:
+                sinks.append(ParquetSink(self.parquet_dir, workout))
+            for samples_df, loc_df in zip(iter_resampled_details(workout, act_details, self.chunk_seconds), loc_chunks):
+                for sink in sinks:
+                    sink.write(samples_df, loc_df)
+            for sink in sinks:
+                sink.close()
+        except BaseException:
+            for sink in sinks:
+                sink.abort()
+            raise
+        if self.manifest is not None:
+            self.manifest.record(workout, tcx_file_name)
+        return tcx_file_name
+
+    def export_workout(self, workout):
+        return self.write_workout(workout, self.fetch_details(workout))
+
+    def export_workouts(self, workouts):
+        # Without a job queue, export the workouts one after the other; with it, queue them
+        # and run all unfinished jobs, including those left by previous runs
+        if self.jobs is None:
+            return [self.export_workout(wk) for wk in workouts]
+        self.jobs.add(workouts)
+        return self.run_jobs()
+
+    def fetch_job(self, workout):
+        # Details of a queued workout, reusing those stored by a previous run; errors are
+        # returned instead of raised, so that they can be recorded when the job is written
+        try:
+            details = self.jobs.details(workout)
+            if details is None:
+                details = self.fetch_details(workout)
+                self.jobs.fetched(workout, details)
+            return details
+        except Exception as e:
+            return e
+
+    def write_job(self, workout, details):
+        # Write a queued workout and record the outcome; returns None if the job failed
+        try:
+            if isinstance(details, Exception):
+                raise details
+            tcx_file_name = self.write_workout(workout, details)
+        except Exception as e:
+            print(f"Error: workout {workout['id']} failed: {e!r}")
+            self.jobs.failed(workout, repr(e))
+            return None
+        self.jobs.written(workout, tcx_file_name)
+        return tcx_file_name
+
+    def run_jobs(self):
+        # Run the unfinished jobs of the queue in startdate order; failed jobs are retried
+        # until they have failed JOB_MAX_ATTEMPTS times
+        tcx_file_names = []
+        for wk in self.jobs.unfinished():
+            tcx_file_name = self.write_job(wk, self.fetch_job(wk))
+            if tcx_file_name is not None:
+                tcx_file_names.append(tcx_file_name)
+        self.print_jobs()
+        return tcx_file_names
+
+    def print_jobs(self):
+        counts = self.jobs.counts()
+        prefix = f"{self.name}: " if self.name is not None else ""
+        print(f"{prefix}Jobs: " + ", ".join(f"{counts[state]} {state}" for state in JobQueue.STATES))
+
+    def is_done(self, workout):
+        # True if this version of the workout does not need to be exported again
+        return self.is_exported(workout) or (self.jobs is not None and self.jobs.is_written(workout))
+
+    def export_since(self, from_date, max_workouts = None):
+        # Export the first max_workouts workouts since from_date, or all of them if max_workouts is None
+        all_workouts = [wk for wk in self.get_workouts_since(from_date) if not self.is_done(wk)]
+        if max_workouts is not None:
+            all_workouts = all_workouts[:max_workouts]
+        tcx_file_names = self.export_workouts(all_workouts)
+        self.print_stats()
+        return tcx_file_names
+
+    def backfill(self, from_date, to_date = None, window = 'month', max_workers = BACKFILL_WORKERS):
+        # Export the whole history since from_date, listing and fetching date windows in parallel
+        # Workouts are still written in startdate order, and each window is checkpointed once all
+        # its workouts are written, so an interrupted backfill resumes with the missing windows
+        if to_date is None:
+            to_date = int(time.time())
+        checkpoint_filename = os.path.join(self.output_dir, BACKFILL_CHECKPOINT)
+        done = set()
+        if os.path.isfile(checkpoint_filename):
+            with open(checkpoint_filename, 'r') as file:
+                done = set(json.load(file)['windows'])
+
+        # The window containing to_date may still get new workouts, so it is never checkpointed
+        last_date = datetime.fromtimestamp(to_date).date().isoformat()
+
+        def complete(key):
+            if key.split('/')[1] < last_date:
+                done.add(key)
+
+        def save_checkpoint():
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(checkpoint_filename, 'w') as file:
+                json.dump({'windows': sorted(done)}, file, indent=2)
+
+        windows = [w for w in date_windows(from_date, to_date, window) if '/'.join(w) not in done]
+        print(f"Backfilling {len(windows)} windows since {datetime.fromtimestamp(from_date)}")
+        access_token = self.get_access_token()
+
+        tcx_file_names = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            def list_window(w):
+                try:
+                    return self.get_workouts_between(w[0], w[1], access_token)
+                except Exception as e:
+                    return e
+
+            listed = pool.map(list_window, windows)
+            # Merge windows into a single startdate-ordered stream, remembering the window of each workout
+            # A window whose listing failed is left out and never checkpointed, so the next run lists it again
+            pending = {}
+            workouts = {}
+            unlisted = []
+            for w, window_workouts in zip(windows, listed):
+                key = '/'.join(w)
+                if isinstance(window_workouts, Exception):
+                    print(f"Error: listing window {key} failed: {window_workouts!r}")
+                    unlisted.append(key)
+                    continue
+                window_workouts = [wk for wk in window_workouts if wk['startdate'] >= from_date and wk['id'] not in workouts
+                                   and not self.is_done(wk)]
+                workouts.update((wk['id'], (key, wk)) for wk in window_workouts)
+                pending[key] = len(window_workouts)
+                if pending[key] == 0:
+                    complete(key)
+            save_checkpoint()
+            merged = sorted(workouts.values(), key=lambda kw: (kw[1]['startdate'], kw[1]['id']))
+            print(f"Backfill found {len(merged)} workouts")
+
+            if self.jobs is not None:
+                self.jobs.add(wk for key, wk in merged)
+                # Jobs that used up their attempts are not run again (until --retryfailed), and
+                # keep their window incomplete
+                merged = [(key, wk) for key, wk in merged if not self.jobs.gave_up(wk)]
+            fetch, write = (self.fetch_job, self.write_job) if self.jobs is not None else (self.fetch_details, self.write_workout)
+            # Fetching runs at most 2 * max_workers workouts ahead of writing, so that fetched
+            # details do not pile up in memory when writing is slower
+            remaining = iter(merged)
+            fetching = collections.deque((kw, pool.submit(fetch, kw[1])) for kw in itertools.islice(remaining, 2 * max_workers))
+            while fetching:
+                (key, wk), future = fetching.popleft()
+                act_details = future.result()
+                for kw in itertools.islice(remaining, 1):
+                    fetching.append((kw, pool.submit(fetch, kw[1])))
+                tcx_file_name = write(wk, act_details)
+                # A failed job leaves its window incomplete, so it is listed again next time
+                if tcx_file_name is None:
+                    continue
+                tcx_file_names.append(tcx_file_name)
+                pending[key] -= 1
+                if pending[key] == 0:
+                    complete(key)
+                    save_checkpoint()
+        if unlisted:
+            print(f"Error: {len(unlisted)} windows could not be listed and will be listed again next time: {', '.join(unlisted)}")
+        if self.jobs is not None:
+            self.print_jobs()
+        self.print_stats()
+        return tcx_file_names
+
+    def subscribe(self, callback_url):
+        return subscribe_notifications(NOTIFY_URL, self.get_access_token(), callback_url, self.session)
+
+    def watch(self, listen_port):
+        notifications = queue.Queue()
+        httpd = start_notification_server(listen_port, notifications)
+        # (id, modified) of workouts already exported, so repeated notifications do not rewrite them
+        exported = set()
+        # (time due, retries so far, notification) of notifications to handle again
+        retries = []
+        try:
+            while True:
+                now = time.monotonic()
+                due = [r for r in retries if r[0] <= now]
+                retries = [r for r in retries if r[0] > now]
+                if due:
+                    _, retry, notification = due[0]
+                    retries.extend(due[1:])
+                else:
+                    try:
+                        notification = notifications.get(timeout=1.0)
+                    except queue.Empty:
+                        continue
+                    retry = 0
+                    print(f"Notification received: {notification}")
+                # An error only affects this notification (or workout); the watcher keeps running, and the
+                # notification is handled again later, when failed workouts are retried
+                failed = False
+                try:
+                    workouts = [wk for wk in self.get_workouts_for_notification(notification)
+                                if (wk['id'], wk.get('modified')) not in exported and not self.is_done(wk)]
+                except Exception as e:
+                    print(f"Error: notification {notification} failed: {e!r}")
+                    workouts = []
+                    failed = True
+                for wk in workouts:
+                    try:
+                        self.export_workouts([wk])
+                    except Exception as e:
+                        print(f"Error: workout {wk['id']} failed: {e!r}")
+                        failed = True
+                        continue
+                    if self.jobs is None or self.jobs.is_written(wk):
+                        exported.add((wk['id'], wk.get('modified')))
+                    else:
+                        failed = True
+                if failed:
+                    if retry < WATCH_MAX_RETRIES:
+                        print(f"Notification will be handled again in {WATCH_RETRY_SECONDS} seconds")
+                        retries.append((time.monotonic() + WATCH_RETRY_SECONDS, retry + 1, notification))
+                    else:
+                        print(f"Error: giving up notification {notification} after {retry} retries")
+                self.print_stats()
+        except KeyboardInterrupt:
+            print("Stopping watch mode")
+        finally:
+            httpd.shutdown()
+
+def load_accounts(accounts_filename, use_keyring = True, **defaults):
+    # Build one Exporter per account listed in a JSON file, e.g.:
+    # [{"name": "alice", "clientid": "...", "clientsecret": "...", "gpxfile": "alice.gpx", "outputdir": "alice"}]
+    # Missing keys take the values in defaults (client_id, client_secret, ...)
+    with open(accounts_filename, 'r') as file:
+        accounts = json.load(file)
+
+    exporters = []
+    for account in accounts:
+        name = account['name']
+        token_store = KeyringTokenStore(name) if use_keyring else FileTokenStore(name)
+        exporters.append(Exporter(account.get('clientid', defaults.get('client_id')),
+                                  account.get('clientsecret', defaults.get('client_secret')),
+                                  token_store=token_store,
+                                  name=name,
+                                  include_autodetected=account.get('autodetected', defaults.get('include_autodetected', False)),
+                                  gpx_filename=account.get('gpxfile'),
+                                  do_not_update_distance=account.get('donotupdatedistance', defaults.get('do_not_update_distance', False)),
+                                  output_dir=account.get('outputdir', name),
+                                  output_layout=account.get('layout', defaults.get('output_layout', 'flat')),
+                                  use_manifest=account.get('manifest', defaults.get('use_manifest', False)),
+                                  skip_exported=account.get('skipexported', defaults.get('skip_exported', False)),
+                                  parquet_dir=account.get('parquetdir', defaults.get('parquet_dir')),
+                                  chunk_seconds=account.get('chunksize', defaults.get('chunk_seconds')),
+                                  use_queue=account.get('queue', defaults.get('use_queue', False)),
+                                  calls_per_minute=account.get('callsperminute', defaults.get('calls_per_minute')),
+                                  callback_port=defaults.get('callback_port', '8000')))
+    return exporters
+
+def export_accounts(exporters, from_date, max_workouts = None, max_workers = None):
+    # Authentication may need a browser and the single callback port, so it is done one account at a time
+    # An account that can not be authenticated is recorded as failed and the others go on
+    results = {}
+    authenticated = []
+    for exporter in exporters:
+        print(f"Authenticating account {exporter.name}")
+        try:
+            exporter.authenticate()
+        except (Exception, SystemExit) as e:
+            results[exporter.name] = None
+            print(f"Error: account {exporter.name} could not be authenticated: {e!r}")
+            continue
+        authenticated.append(exporter)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(authenticated) or 1) as pool:
+        futures = {pool.submit(exporter.export_since, from_date, max_workouts): exporter for exporter in authenticated}
+        for future in as_completed(futures):
+            exporter = futures[future]
+            try:
+                results[exporter.name] = future.result()
+                print(f"Account {exporter.name}: {len(results[exporter.name])} workouts exported")
+            except (Exception, SystemExit) as e:
+                results[exporter.name] = None
+                print(f"Error: account {exporter.name} failed: {e!r}")
+    return results
+
+def main():
     # Get these from your environment variables
     CLIENT_ID = os.environ.get('WITHINGS_CLIENT_ID','0000')
     CLIENT_SECRET = os.environ.get('WITHINGS_CLIENT_SECRET','0000')
     CALLBACK_PORT = os.environ.get('WITHINGS_CALLBACK_PORT','8000')
-    REDIRECT_URI = 'http://localhost:' + CALLBACK_PORT
-    AUTH_URL = 'https://account.withings.com/oauth2_user/authorize2'
-    TOKEN_URL = 'https://wbsapi.withings.net/v2/oauth2'
-    API_URL = 'https://wbsapi.withings.net/v2/measure'
+    NOTIFY_PORT = os.environ.get('WITHINGS_NOTIFY_PORT','8001')
+    NOTIFY_CALLBACK_URL = os.environ.get('WITHINGS_NOTIFY_CALLBACK_URL')
 
     FROM_DATE = os.environ.get('FROM_DATE','1970-01-01T00:00:00Z')
 
@@ -665,72 +1951,143 @@ def main():
     parser.add_argument('-k', '--donotusekeyring', action='store_true', help="do not use keyring to store refresh tokens and instead store in a file")
     parser.add_argument('-v', '--version', action='version', version=VERSION)
     parser.add_argument('-t', '--autodetected', action='store_true', help='include autodetected workouts (not confirmed by user). Default is only confirmed.')
-    parser.add_argument('-g', '--gpxfile', help='gpx file with location information')
+    parser.add_argument('-g', '--gpxfile', action='append', help='gpx file with location information (can be given several times)')
     parser.add_argument('--donotupdatedistance', action='store_true', help='if set, do not update TCX total distance with calculated from GPX')
+    parser.add_argument('-w', '--watch', action='store_true', help='keep running and export workouts as Withings notifies them')
+    parser.add_argument('--notifyport', help='local port where notifications are received in watch mode')
+    parser.add_argument('--notifycallbackurl', help='public url forwarded to the notify port, used to subscribe to Withings notifications')
+    parser.add_argument('--simulatenotification', nargs=2, metavar=('STARTDATE', 'ENDDATE'), help='send a fake activity notification to a running watcher and exit')
+    parser.add_argument('--accounts', help='json file listing several accounts to export concurrently')
+    parser.add_argument('--workers', type=int, help='maximum number of accounts exported at the same time, of parallel requests when backfilling, or of processes when enriching')
+    parser.add_argument('-o', '--outputdir', default='.', help='directory where .tcx files are written (default is the current directory)')
+    parser.add_argument('--layout', choices=['flat', 'partitioned'], default='flat', help='write all files in the output directory (flat, default) or in YYYY/MM subdirectories (partitioned)')
+    parser.add_argument('-m', '--manifest', action='store_true', help=f'keep an index of exported workouts in {MANIFEST_FILENAME} in the output directory')
+    parser.add_argument('--skipexported', action='store_true', help='do not export again workouts already in the manifest and unmodified since (implies --manifest)')
+    parser.add_argument('--listexported', action='store_true', help='list workouts in the manifest since initial date and exit')
+    parser.add_argument('--category', type=int, help='with --listexported, only list workouts of this Withings sport category')
+    parser.add_argument('--device', help='with --listexported, only list workouts recorded by this device id')
+    parser.add_argument('-p', '--parquet', metavar='DIR', help='also add the per-second samples and summary of each workout to parquet datasets in DIR (needs pyarrow)')
+    parser.add_argument('--chunksize', type=int, metavar='SECONDS', help='resample and write workouts SECONDS at a time, to bound memory use with very long workouts')
+    parser.add_argument('-q', '--queue', action='store_true', help=f'keep export jobs in {JOBS_FILENAME} in the output directory, so that a failed workout does not stop the run and an interrupted run resumes where it stopped')
+    parser.add_argument('--resume', action='store_true', help='only run the unfinished jobs of the queue, without listing workouts again (implies --queue)')
+    parser.add_argument('--retryfailed', action='store_true', help=f'retry queued jobs that already failed {JOB_MAX_ATTEMPTS} times (implies --queue)')
+    parser.add_argument('-e', '--enrich', metavar='TCXDIR', help='add location from the gpx files to all .tcx files under TCXDIR, without calling Withings, and exit')
+    parser.add_argument('--enrichoutput', metavar='DIR', help='write enriched .tcx files to DIR instead of replacing the originals')
+    parser.add_argument('-b', '--backfill', action='store_true', help='export all workouts since initial date, listing and fetching date windows in parallel and resuming from the last checkpoint')
+    parser.add_argument('--window', choices=['month', 'week'], default='month', help='size of the date windows used by --backfill (default is month)')
     args = parser.parse_args()
 
     if args.datefrom:
         args_date = dp.parse(args.datefrom)
         FROM_DATE = args_date.isoformat()
-    if args.all:
-        EXPORT_ALL_WORKOUTS = True
-    if args.one:
-        EXPORT_ONE_WORKOUT = True
     if args.clientid:
         CLIENT_ID = args.clientid
     if args.clientsecret:
         CLIENT_SECRET = args.clientsecret
-    if args.donotusekeyring:
-        USE_KEYRING = False
-    if args.autodetected:
-        INCLUDE_AUTODETECTED_WORKOUTS = True
-    if args.gpxfile:
-        GPX_FILENAME = args.gpxfile
-    if args.donotupdatedistance:
-        DO_NOT_UPDATE_DISTANCE = args.donotupdatedistance
-
-    # Check if refresh_token exists and is valid
-    access_token = None
-    refresh_token = load_refresh_token()
-    if refresh_token is not None:
-        access_token, refresh_token = get_access_tokens_refresh(TOKEN_URL, CLIENT_ID, CLIENT_SECRET, refresh_token)
-    if access_token is None:
-        # Need to get authorization code
-        auth_code = get_authorization_code(AUTH_URL, CLIENT_ID, REDIRECT_URI, CALLBACK_PORT)
-        access_token, refresh_token = get_access_tokens_auth(TOKEN_URL, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, auth_code)
-    save_refresh_token(refresh_token)
-
+    if args.notifyport:
+        NOTIFY_PORT = args.notifyport
+    if args.notifycallbackurl:
+        NOTIFY_CALLBACK_URL = args.notifycallbackurl
+
+    if args.simulatenotification:
+        simulate_notification(NOTIFY_PORT,
+                              int(dp.parse(args.simulatenotification[0]).timestamp()),
+                              int(dp.parse(args.simulatenotification[1]).timestamp()))
+        return
+
+    if args.enrich:
+        gpx_untrimmed_df = parse_gpx_to_untrimmed_df(args.gpxfile)
+        if gpx_untrimmed_df is None:
+            print("Error: --enrich needs at least one gpx file (-g)")
+            sys.exit(2)
+        enrich_tcx_dir(args.enrich, gpx_untrimmed_df, args.enrichoutput, args.donotupdatedistance, args.workers)
+        return
 
     from_date = int(dp.isoparse(FROM_DATE).timestamp())
-    print(f"Fetching workouts since {datetime.fromtimestamp(from_date)}")
 
-    all_workouts = get_all_workouts_since(API_URL, access_token, from_date)
+    if args.listexported:
+        manifest_filename = os.path.join(args.outputdir, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_filename):
+            print(f"Error: no manifest found at {manifest_filename}")
+            sys.exit(2)
+        manifest = Manifest(manifest_filename)
+        for row in manifest.find(since=from_date, category=args.category, deviceid=args.device):
+            print(f"{row['id']}: {datetime.fromtimestamp(row['startdate'])}, category {row['category']}, "
+                  f"{row['duration']:.0f} s, {row['distance'] or 0.0:.0f} m, {row['path']}")
+        manifest.close()
+        return
+
+    if args.parquet and pq is None:
+        print("Error: --parquet needs pyarrow (pip install pyarrow)")
+        sys.exit(2)
 
-    wkouts_to_export = 0
-    if EXPORT_ONE_WORKOUT: wkouts_to_export = 1
-    if EXPORT_ALL_WORKOUTS: wkouts_to_export = len(all_workouts)
-    wkouts_to_export = min( wkouts_to_export, len(all_workouts))
-    gpx_untrimmed_df = None
-    gpx_fn = GPX_FILENAME
-    if gpx_fn is not None:
-        gpx_untrimmed_df = parse_gpx_to_untrimmed_df(gpx_fn)
+    max_workouts = 0
+    if args.one: max_workouts = 1
+    if args.all: max_workouts = None
 
-    for thiswkout in all_workouts[:wkouts_to_export]:
-        act_details = get_intradayactivity(API_URL, access_token, thiswkout['startdate'], thiswkout['enddate'])
+    use_queue = args.queue or args.resume or args.retryfailed
+    if args.resume and (args.accounts or args.watch or args.backfill):
+        print("Error: --resume can not be combined with --accounts, --watch or --backfill")
+        sys.exit(2)
 
-        tcx_file_name = ''.join([timestamp_to_filename(thiswkout['startdate']), '.tcx'])
-        print(f"Workout has {len(act_details)} detailed entries. Filename: {tcx_file_name}")
+    if args.accounts:
+        exporters = load_accounts(args.accounts, not args.donotusekeyring,
+                                  client_id=CLIENT_ID,
+                                  client_secret=CLIENT_SECRET,
+                                  include_autodetected=args.autodetected,
+                                  do_not_update_distance=args.donotupdatedistance,
+                                  output_layout=args.layout,
+                                  use_manifest=args.manifest,
+                                  skip_exported=args.skipexported,
+                                  parquet_dir=args.parquet,
+                                  chunk_seconds=args.chunksize,
+                                  use_queue=use_queue,
+                                  callback_port=CALLBACK_PORT)
+        if args.retryfailed:
+            for exporter in exporters:
+                if exporter.jobs is not None: exporter.jobs.retry_failed()
+        print(f"Fetching workouts since {datetime.fromtimestamp(from_date)} for {len(exporters)} accounts")
+        export_accounts(exporters, from_date, max_workouts, args.workers)
+        return
+
+    exporter = Exporter(CLIENT_ID, CLIENT_SECRET,
+                        token_store=FileTokenStore() if args.donotusekeyring else KeyringTokenStore(),
+                        include_autodetected=args.autodetected,
+                        gpx_filename=args.gpxfile,
+                        do_not_update_distance=args.donotupdatedistance,
+                        output_dir=args.outputdir,
+                        output_layout=args.layout,
+                        use_manifest=args.manifest,
+                        skip_exported=args.skipexported,
+                        parquet_dir=args.parquet,
+                        chunk_seconds=args.chunksize,
+                        use_queue=use_queue,
+                        callback_port=CALLBACK_PORT)
+    if args.retryfailed:
+        exporter.jobs.retry_failed()
 
-        gpx_df = create_loc_df(gpx_untrimmed_df, int(thiswkout['startdate']), int(thiswkout['enddate']))
-        
-        tcx = create_tcx(thiswkout, act_details, gpx_df)
-        #ET.indent(tcx)
-        #ET.dump(tcx)
-        ET.ElementTree(tcx).write(tcx_file_name,
-                                  xml_declaration=True,
-                                  encoding='UTF-8',
-                                  method='xml',
-                                  short_empty_elements=False)
+    try:
+        exporter.authenticate()
+
+        if args.watch:
+            if NOTIFY_CALLBACK_URL is not None:
+                exporter.subscribe(NOTIFY_CALLBACK_URL)
+            exporter.watch(NOTIFY_PORT)
+            return
+
+        if args.backfill:
+            exporter.backfill(from_date, window=args.window, max_workers=args.workers or BACKFILL_WORKERS)
+            return
+
+        if args.resume:
+            exporter.run_jobs()
+            return
+
+        print(f"Fetching workouts since {datetime.fromtimestamp(from_date)}")
+        exporter.export_since(from_date, max_workouts)
+    except WithingsAPIError as e:
+        print(f"Error: {e}")
+        sys.exit(2)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()